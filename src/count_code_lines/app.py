@@ -1,7 +1,7 @@
 # /// script
 # requires-python = "==3.12"
 # dependencies = [
-#     "millify==0.1.1",
+#     "orjson==3.10.7",
 #     "plotext",
 #     "py-markdown-table==1.1.0",
 #     "pygount==1.8.0",
@@ -12,35 +12,36 @@
 # ///
 
 import datetime
+import functools
+import hashlib
 import json
 import collections
+import os
+import subprocess
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from json import JSONDecodeError
 from typing import Literal, Any, Annotated
 
-import millify
-from pygount.command import pygount_command
 import requests
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tempfile import NamedTemporaryFile
 from pathlib import Path
 import typer
-from py_markdown_table.markdown_table import markdown_table
-from git import Repo
 from enum import StrEnum, auto
 from rich.logging import RichHandler
 import logging
 from rich.console import Console
 from rich import print_json
-import warnings
-import plotext as plt
-import base64
 
-__email__ = "daniel@engvalls.eu"
-
-from rich.table import Table
-
-warnings.filterwarnings(action="ignore", module="millify")
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+__email__ = "daniel@engvalls.eu"
 
 logging.basicConfig(
     level=logging.INFO,
@@ -52,18 +53,85 @@ logger = logging.getLogger(__name__)
 
 
 EXCLUDE_PATTERN = "...,zope,twisted,garden"
+MAX_WORKERS = 8
+CACHE_DIR = Path.home() / ".cache" / "count_code_lines"
+PYGOUNT_CACHE_TTL = datetime.timedelta(days=7)
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+REQUEST_TIMEOUT = (3, 10)
+RATE_LIMIT_THRESHOLD = 10
+GITHUB_REPOS_QUERY = """
+query($user: String!, $after: String) {
+  user(login: $user) {
+    repositories(
+      first: 100, after: $after, ownerAffiliations: OWNER, privacy: PUBLIC
+    ) {
+      nodes { name url createdAt }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+MERMAID_PREFIX_TEMPLATE = """
+```mermaid
+xychart-beta
+      title "{title}"
+      x-axis "{x_axis_title}" """
 
-Repository = collections.namedtuple("repo", "name url year")
+Repository = collections.namedtuple("Repository", "name url year")
 CountSummary = dict[Literal["dirs", "github"], collections.Counter]
 ReposSummary = tuple[dict[str | Any, dict]]
-Years = Annotated[set, "years"]
+Years = Annotated[list, "years"]
 SourceLinesPerYear = tuple[
     Annotated[str, "source name"],
     Annotated[collections.defaultdict[str, list], "source and per year"],
 ]
+Aggregates = collections.namedtuple(
+    "Aggregates",
+    "all_years per_source_per_year total_lines repo_count sorted_repos",
+)
 
 cli_app = typer.Typer()
 
+_SESSION = requests.Session()
+_SESSION.headers.update(
+    {"Accept": "application/vnd.github+json", "User-Agent": "count-code-lines"}
+)
+if GITHUB_TOKEN:
+    _SESSION.headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=6,
+            backoff_factor=1.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,  # GraphQL queries are POSTs but safe to retry
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+    ),
+)
+_rate_limit_reset: float | None = None
+
+
+def _track_rate_limit(response: requests.Response, *args, **kwargs) -> None:
+    global _rate_limit_reset
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is not None and reset is not None:
+        low = int(remaining) < RATE_LIMIT_THRESHOLD
+        _rate_limit_reset = float(reset) if low else None
+
+
+_SESSION.hooks["response"].append(_track_rate_limit)
+
+
+class GithubApiError(Exception):
+    pass
+
 
 class OutputFormat(StrEnum):
     MARKDOWN = auto()
@@ -71,23 +139,58 @@ class OutputFormat(StrEnum):
     RICH = auto()
 
 
-def get_code_per_year_source(summary: dict) -> tuple[Years, SourceLinesPerYear]:
+@functools.cache
+def _short_name(source: str) -> str:
+    return source.rsplit("/", 1).pop()
+
+
+def _by_year(repo_item: tuple[str, dict]) -> int:
+    return repo_item[1]["year"]
+
+
+def _aggregate(summaries: dict[str, dict]) -> Aggregates:
     """
-    :param summary: A dictionary containing source, repository, and data for each code summary.
-    :return: A tuple containing a set of all years and a dictionary with source lines per year for each source.
+    :param summaries: A dictionary containing source, repository, and data for each code summary.
+    :return: Sorted years, lines per year for each source, total lines, number of repositories
+        and the repositories of each source sorted by year, in one pass.
     """
     all_years = set()
-    for source, repos in summary.items():
-        for repo, data in repos.items():
+    totals = {}
+    total_lines = 0
+    repo_count = 0
+    sorted_repos = {}
+    for source, repos in summaries.items():
+        sorted_repos[source] = sorted(repos.items(), key=_by_year)
+        source_totals = totals.setdefault(source, collections.Counter())
+        for data in repos.values():
             all_years.add(data["year"])
-    source_lines_per_year = collections.defaultdict(list)
-    for source, repos in summary.items():
-        c = collections.Counter()
-        for repo, data in repos.items():
-            c[data["year"]] += data["totalCodeCount"]
-        for year, count in c.items():
-            source_lines_per_year[source].append(count)
-    return all_years, source_lines_per_year
+            source_totals[data["year"]] += data["totalCodeCount"]
+            total_lines += data["totalCodeCount"]
+            repo_count += 1
+    years_sorted = sorted(all_years)
+    # Align each source with the sorted years so every position matches the x-axis
+    per_source_per_year = {
+        source: [source_totals[year] for year in years_sorted]
+        for source, source_totals in totals.items()
+        if source_totals
+    }
+    return Aggregates(
+        years_sorted, per_source_per_year, total_lines, repo_count, sorted_repos
+    )
+
+
+def get_code_per_year_source(summary: dict) -> tuple[Years, SourceLinesPerYear]:
+    """
+    :param summary: A dictionary containing source, repository, and data for each code summary.
+    :return: A tuple containing a sorted list of all years and a dictionary with source lines per year for each source.
+    """
+    aggregates = _aggregate(summary)
+    return aggregates.all_years, aggregates.per_source_per_year
+
+
+@functools.lru_cache
+def _mermaid_prefix(title: str, x_axis_title: str) -> str:
+    return MERMAID_PREFIX_TEMPLATE.format(title=title, x_axis_title=x_axis_title)
 
 
 def code_per_year_to_mermaid_chart(
@@ -97,24 +200,18 @@ def code_per_year_to_mermaid_chart(
     x_axis_title: str = "Year",
 ) -> str:
     """
-    :param all_years: A list of all years for which the data is provided.
+    :param all_years: A sorted list of all years for which the data is provided.
     :param per_source: A dictionary mapping source names to lines of code per year.
     :param title: The title of the chart. Defaults to "Line of codes per year".
     :param x_axis_title: The label for the x-axis. Defaults to "Year".
     :return: A string representing a Mermaid chart displaying the lines of code per year.
     """
-    prefix = f"""
-```mermaid
-xychart-beta
-      title "{title}"
-      x-axis "{x_axis_title}" {json.dumps(list(all_years))}
-"""
-    data_lines = []
-    for source, data_list in per_source.items():
-        data_lines.append(
-            f'      bar "{source.split('/').pop()}" {json.dumps(data_list)}'
-        )
-    return prefix + "\n".join(data_lines) + "\n```"
+    prefix = _mermaid_prefix(title, x_axis_title) + json.dumps(all_years) + "\n"
+    data_lines = "\n".join(
+        f'      bar "{_short_name(source)}" {json.dumps(data_list)}'
+        for source, data_list in per_source.items()
+    )
+    return prefix + data_lines + "\n```"
 
 
 def print_code_per_year_to_plotext_chart(
@@ -122,171 +219,388 @@ def print_code_per_year_to_plotext_chart(
     per_source: SourceLinesPerYear,
     title: str = "Line of codes per year",
 ):
+    import plotext as plt
+
     years = all_years
     plt.simple_stacked_bar(
         years,
         list(per_source.values()),
         width=100,
-        labels=[_.split("/").pop() for _ in per_source.keys()],
+        labels=[_short_name(_) for _ in per_source.keys()],
         title=title,
     )
     plt.show()
 
 
+def _json_dumps(obj: Any) -> str:
+    if orjson is None:
+        return json.dumps(obj)
+    return orjson.dumps(obj).decode()
+
+
+def _json_loads(data: str | bytes) -> Any:
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+def _read_json_cache(cache_file: Path) -> dict:
+    try:
+        return _json_loads(cache_file.read_bytes())
+    except (OSError, JSONDecodeError):
+        return {}
+
+
+def _write_json_cache(cache_file: Path, data: dict) -> None:
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(
+            "w", dir=cache_file.parent, suffix=".tmp", delete=False
+        ) as tmp_file:
+            tmp_file.write(_json_dumps(data))
+        Path(tmp_file.name).replace(cache_file)
+    except OSError as e:
+        logger.warning(f"Unable to write cache {cache_file}: {e}")
+
+
+def _wait_for_rate_limit() -> None:
+    if _rate_limit_reset is None:
+        return
+    if (delay := _rate_limit_reset - time.time()) > 0:
+        logger.warning(f"Github rate limit almost used, waiting {delay:.0f}s")
+        time.sleep(delay)
+
+
+def _github_error(response: requests.Response) -> GithubApiError:
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    message = body.get("message") if isinstance(body, dict) else response.reason
+    return GithubApiError(
+        f"Github API {response.url} failed ({response.status_code}): {message}"
+    )
+
+
+def _get_github_pages(url: str) -> list[dict]:
+    """
+    :param url: The Github API URL of the first page of a listing.
+    :return: Items of all pages, pages unchanged since last run are served from cache by their ETag.
+    """
+    etags_cache = CACHE_DIR / "github_etags.json"
+    cached_pages = _read_json_cache(etags_cache)
+    items = []
+    page_url = url
+    while page_url:
+        cached = cached_pages.get(page_url)
+        headers = {"If-None-Match": cached["etag"]} if cached else {}
+        _wait_for_rate_limit()
+        response = _SESSION.get(page_url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            page, next_url = cached["body"], cached["next"]
+        else:
+            if not response.ok:
+                raise _github_error(response)
+            page = response.json()
+            if not isinstance(page, list):
+                raise GithubApiError(f"Unexpected response from {page_url}: {page}")
+            next_url = response.links.get("next", {}).get("url")
+            if etag := response.headers.get("ETag"):
+                cached_pages[page_url] = {"etag": etag, "body": page, "next": next_url}
+        items.extend(page)
+        page_url = next_url
+    _write_json_cache(etags_cache, cached_pages)
+    return items
+
+
+def _get_github_repos_graphql(user: str) -> list[dict]:
+    """
+    :param user: The Github user owning the repositories.
+    :return: Name, URL and creation date of all repositories, fetched 100 per request.
+    """
+    nodes = []
+    after = None
+    while True:
+        _wait_for_rate_limit()
+        response = _SESSION.post(
+            f"{GITHUB_API_URL}/graphql",
+            json={
+                "query": GITHUB_REPOS_QUERY,
+                "variables": {"user": user, "after": after},
+            },
+            timeout=REQUEST_TIMEOUT,
+        )
+        if not response.ok:
+            raise _github_error(response)
+        body = response.json()
+        # GraphQL reports failures such as an unknown user with a 200 status
+        if body.get("errors") or not (body.get("data") or {}).get("user"):
+            raise GithubApiError(f"Unable to list repositories of {user}: {body}")
+        repositories = body["data"]["user"]["repositories"]
+        nodes.extend(repositories["nodes"])
+        if not repositories["pageInfo"]["hasNextPage"]:
+            return nodes
+        after = repositories["pageInfo"]["endCursor"]
+
+
+@functools.lru_cache(maxsize=32)
 def get_all_github_repos(user="engdan77") -> list[Repository]:
     repos = []
-    for r in requests.get(f"https://api.github.com/users/{user}/repos").json():
-        year = r["created_at"].split("-").pop(0)
+    # The GraphQL API refuses unauthenticated requests
+    if GITHUB_TOKEN:
+        for r in _get_github_repos_graphql(str(user)):
+            year = int(r["createdAt"].split("-").pop(0))
+            repos.append(Repository(r["name"], f"{r['url']}.git", year))
+        return sorted(repos, key=lambda x: x.year)
+    for r in _get_github_pages(f"{GITHUB_API_URL}/users/{user}/repos?per_page=100"):
+        year = int(r["created_at"].split("-").pop(0))
         repos.append(Repository(r["name"], f"{r['html_url']}.git", year))
     return sorted(repos, key=lambda x: x.year)
 
 
-def get_repo_summary_file(
-    tmp_file: NamedTemporaryFile, repo_folder: Path | str
-) -> dict:
+def _run_git(*args: str) -> str | None:
+    try:
+        # Fail instead of prompting for credentials on unreachable repositories
+        proc = subprocess.run(
+            ["git", *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return proc.stdout.strip()
+
+
+def _get_repo_revision(repo_folder: Path | Repository) -> str | None:
+    """
+    :param repo_folder: A local repository or a Github repository.
+    :return: The HEAD commit, None if unknown or the working tree has uncommitted changes.
+    """
+    if isinstance(repo_folder, Repository):
+        # Resolve the remote HEAD without cloning
+        refs = _run_git("ls-remote", repo_folder.url, "HEAD")
+        return refs.split().pop(0) if refs else None
+    status = _run_git(
+        "-C", repo_folder.as_posix(), "status", "--porcelain=v2", "--branch"
+    )
+    if not status:
+        return None
+    lines = status.splitlines()
+    # Uncommitted edits are not part of any commit, so such trees are always counted
+    if any(not line.startswith("#") for line in lines):
+        return None
+    for line in lines:
+        if line.startswith("# branch.oid "):
+            oid = line.split().pop()
+            return None if oid == "(initial)" else oid
+    return None
+
+
+def _get_pygount_cache_file(repo_folder: Path | Repository) -> Path | None:
+    """
+    :param repo_folder: A local repository or a Github repository.
+    :return: The cache file keyed on location and commit, None if the revision is unknown.
+    """
+    revision = _get_repo_revision(repo_folder)
+    if revision is None:
+        return None
+    if isinstance(repo_folder, Repository):
+        location = repo_folder.url
+    else:
+        location = repo_folder.resolve().as_posix()
+    key = f"{location}:{revision}:{EXCLUDE_PATTERN}"
+    return CACHE_DIR / "pygount" / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+
+def _read_fresh_cache(cache_file: Path | None) -> dict:
+    if cache_file is None:
+        return {}
+    try:
+        age = time.time() - cache_file.stat().st_mtime
+    except OSError:
+        return {}
+    if age >= PYGOUNT_CACHE_TTL.total_seconds():
+        return {}
+    return _read_json_cache(cache_file)
+
+
+def _count_repo(repo_folder: Path | Repository, cache_file: Path | None) -> dict:
+    from pygount.command import pygount_command
+
     if isinstance(repo_folder, Path):
         f = repo_folder.as_posix()
     else:
         f = repo_folder.url
     args = ["--folders-to-skip", EXCLUDE_PATTERN] if EXCLUDE_PATTERN else []
-    args.extend(["--format", "json", "--out", tmp_file.name, f])
-    pygount_command(args)
-    try:
-        summary = json.loads(open(tmp_file.name).read())["summary"]
-        summary["year"] = get_repo_create_year(repo_folder)
-    except JSONDecodeError:
-        logger.warning(f"Unable to find data for {repo_folder}")
-        summary = {}
+    # pygount's progress bar also goes to stdout, so the report gets a file of its own
+    with NamedTemporaryFile(suffix=".json") as tmp_file:
+        args.extend(["--format", "json", "--out", tmp_file.name, f])
+        pygount_command(args)
+        try:
+            summary = _json_loads(Path(tmp_file.name).read_bytes())["summary"]
+        except JSONDecodeError:
+            logger.warning(f"Unable to find data for {repo_folder}")
+            summary = {}
+    if cache_file and summary:
+        _write_json_cache(cache_file, summary)
     return summary
 
 
-def get_repo_create_year(source: str | Repository) -> int:
-    with TemporaryDirectory() as tmp_folder:
-        if isinstance(source, Repository):
-            r = Repo.clone_from(source.url, tmp_folder)
-        else:
-            r = Repo(source)
-        first_commit = next(r.iter_commits())
-        year = datetime.datetime.fromtimestamp(first_commit.committed_date).year
-        return year
+@functools.lru_cache
+def _year_for_path(path: str) -> int:
+    # Plain git prints one timestamp per root commit without building commit objects
+    root_commits = subprocess.run(
+        ["git", "-C", path, "log", "--max-parents=0", "--format=%ct", "HEAD"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    first_commit_date = min(int(t) for t in root_commits.stdout.split())
+    return datetime.datetime.fromtimestamp(first_commit_date).year
+
+
+def get_repo_create_year(source: Path | Repository) -> int:
+    if isinstance(source, Repository):
+        # Already known from the creation date reported by Github, no need to clone
+        return source.year
+    return _year_for_path(Path(source).resolve().as_posix())
 
 
 def get_summaries(sources, parse_sub_folders_as_repos) -> dict[str, dict]:
-    summarization = collections.defaultdict(dict)
-    with NamedTemporaryFile() as tmp_file:
-        logger.info(f"Temp file {tmp_file.name}")
-        for source in sources:
-            repo_item: Path | str = Path(source.strip("\"'"))
-            if repo_item.is_dir():
-                if parse_sub_folders_as_repos:
-                    process_sources = repo_item.glob("*/")
-                else:
-                    process_sources = [repo_item]
+    jobs = []
+    for source in sources:
+        repo_item: Path | str = Path(source.strip("\"'"))
+        if repo_item.is_dir():
+            if parse_sub_folders_as_repos:
+                process_sources = repo_item.glob("*/")
             else:
-                process_sources = get_all_github_repos(repo_item)
+                process_sources = [repo_item]
+        else:
+            process_sources = get_all_github_repos(repo_item)
+        jobs.extend((source, process_source) for process_source in process_sources)
 
-            for process_source in process_sources:
+    summarization = collections.defaultdict(dict)
+    # Reading git history is I/O-bound so threads suffice, pygount is CPU-bound and gets processes.
+    # The thread pool is shut down before forking workers, forking a process that still
+    # runs threads may copy locks held by them into the children.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as git_pool:
+        year_futures = [git_pool.submit(get_repo_create_year, s) for _, s in jobs]
+        cache_files = list(git_pool.map(_get_pygount_cache_file, [s for _, s in jobs]))
+    summaries = [_read_fresh_cache(cache_file) for cache_file in cache_files]
+    to_count = [i for i, summary in enumerate(summaries) if not summary]
+    logger.info(f"{len(jobs) - len(to_count)} of {len(jobs)} repositories cached")
+    # Skip starting worker processes when nothing changed since the last run
+    if to_count:
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS) as count_pool:
+            count_futures = {}
+            for i in to_count:
+                source, process_source = jobs[i]
                 logger.info(f"Processing {source} / {process_source.name.strip()}")
-                summary = get_repo_summary_file(tmp_file, process_source)
-                summarization[source.removesuffix("/")][process_source.name] = summary
+                count_futures[i] = count_pool.submit(
+                    _count_repo, process_source, cache_files[i]
+                )
+            for i, count_future in count_futures.items():
+                summaries[i] = count_future.result()
+    for (source, process_source), summary, year_future in zip(
+        jobs, summaries, year_futures
+    ):
+        if summary:
+            summary["year"] = year_future.result()
+        summarization[source.removesuffix("/")][process_source.name] = summary
     return summarization
 
 
 def output_as_markdown(summaries: dict[str, dict]) -> str:
-    output_markdown = ""
+    from py_markdown_table.markdown_table import markdown_table
 
-    for source in summaries:
-        table_data = []
-        source_data = dict(
-            sorted(summaries[source].items(), key=lambda x: x[1]["year"])
-        )
-        output_markdown += f'\n\n### {source.split('/').pop()}\n\n'
-        for repo_name, data in source_data.items():
+    aggregates = _aggregate(summaries)
+    table_data = []
+    for source, source_data in aggregates.sorted_repos.items():
+        source_name = _short_name(source)
+        for repo_name, data in source_data:
             table_data.append(
                 {
+                    "source": source_name,
                     "repo_name": repo_name,
                     "year": data["year"],
                     "lines_of_code": data["totalCodeCount"],
                 }
             )
-        output_markdown += "\n\n" + markdown_table(table_data).get_markdown()
+    output_markdown = "\n\n" + markdown_table(table_data).get_markdown()
 
-    output_markdown += "\n\n## Summary\n\n".replace(
-        "\n\n\n", "\n\n"
-    )  # TODO: Investigate where newlines comes from
+    output_markdown += "\n\n## Summary\n\n"
 
-    all_years, data = get_code_per_year_source(summaries)
-    output = code_per_year_to_mermaid_chart(all_years, data)
+    output = code_per_year_to_mermaid_chart(
+        aggregates.all_years, aggregates.per_source_per_year
+    )
     output_markdown += output
     return output_markdown
 
 
 def print_output_as_rich(summaries: dict[str, dict]) -> None:
-    console = Console()
-    for source in summaries:
-        table = Table(title=source)
-        table.add_column("Project", justify="right", style="cyan", no_wrap=True)
-        table.add_column("Year", style="magenta")
-        table.add_column("Lines of code", justify="right", style="green")
-        source_data = dict(
-            sorted(summaries[source].items(), key=lambda x: x[1]["year"])
-        )
-        for repo_name, data in source_data.items():
-            table.add_row(repo_name, str(data["year"]), str(data["totalCodeCount"]))
-        console.print(table)
+    from rich.table import Table
 
-    d = get_summary_of_all(summaries)
-    console.print(
-        f'[bold]Total line codes: [/bold] {millify.millify(d['total_lines'])}'
-    )
+    aggregates = _aggregate(summaries)
+    console = Console()
+    table = Table()
+    table.add_column("Source", style="blue")
+    table.add_column("Project", justify="right", style="cyan", no_wrap=True)
+    table.add_column("Year", style="magenta")
+    table.add_column("Lines of code", justify="right", style="green")
+    for source, source_data in aggregates.sorted_repos.items():
+        source_name = _short_name(source)
+        rows = [
+            (source_name, repo_name, f"{data['year']}", f"{data['totalCodeCount']:,}")
+            for repo_name, data in source_data
+        ]
+        for row in rows:
+            table.add_row(*row)
+        table.add_section()
+    console.print(table)
+
+    d = _summary_of_aggregates(aggregates)
+    console.print(f'[bold]Total line codes: [/bold] {d['total_lines']:,}')
     console.print(f'[bold]Projects: [/bold] {d['repo_count']}')
     console.print(f'[bold]Across years: [/bold] {d['across_years']}')
 
-    all_years, data = get_code_per_year_source(summaries)
-    print_code_per_year_to_plotext_chart(all_years, data)
+    print_code_per_year_to_plotext_chart(
+        aggregates.all_years, aggregates.per_source_per_year
+    )
 
 
 def output_as_json(summaries: dict[str, dict]) -> dict:
-    output_json = {}
-    for source in summaries:
-        source_data = dict(
-            sorted(summaries[source].items(), key=lambda x: x[1]["year"])
-        )
-        source_name = f'{source.split('/').pop()}'
-        repos_result = []
-        for repo in source_data:
-            repos_result.append(
-                {
-                    "repo_name": repo,
-                    "year": source_data[repo]["year"],
-                    "lines_of_code": source_data[repo]["totalCodeCount"],
-                }
-            )
-        output_json[source_name] = repos_result
-
-    all_years, data = get_code_per_year_source(summaries)
-    mermaid = code_per_year_to_mermaid_chart(all_years, data)
-    output_json['b64_mermaid_chart'] = base64.b64encode(mermaid.encode('utf-8')).decode('utf-8')
+    aggregates = _aggregate(summaries)
+    output_json = {
+        _short_name(source): [
+            {
+                "repo_name": repo,
+                "year": data["year"],
+                "lines_of_code": data["totalCodeCount"],
+            }
+            for repo, data in source_data
+        ]
+        for source, source_data in aggregates.sorted_repos.items()
+    }
+    output_json["mermaid_chart"] = code_per_year_to_mermaid_chart(
+        aggregates.all_years, aggregates.per_source_per_year
+    )
     return output_json
 
 
-def get_summary_of_all(summaries: dict[str, dict]) -> dict[str, int]:
-    years = set()
-    total_count = 0
-    repo_count = 0
-    for source, repos in summaries.items():
-        for repo_name, repo_data in repos.items():
-            repo_count += 1
-            years.add(repo_data["year"])
-            total_count += repo_data["totalCodeCount"]
-    across_years = max(years) - min(years)
+def _summary_of_aggregates(aggregates: Aggregates) -> dict[str, int]:
     return {
-        "total_lines": total_count,
-        "repo_count": repo_count,
-        "across_years": across_years,
+        "total_lines": aggregates.total_lines,
+        "repo_count": aggregates.repo_count,
+        "across_years": max(aggregates.all_years) - min(aggregates.all_years),
     }
 
 
+def get_summary_of_all(summaries: dict[str, dict]) -> dict[str, int]:
+    return _summary_of_aggregates(_aggregate(summaries))
+
+
 @cli_app.command()
 def repos_summary(
     repos: list[str] = typer.Argument(..., help="Either a path or an URL"),
@@ -303,7 +617,7 @@ def repos_summary(
             print_output_as_rich(r)
         case OutputFormat.JSON:
             d = output_as_json(r)
-            j = json.dumps(d)
+            j = _json_dumps(d)
             print_json(j)
             return d
 